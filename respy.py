@@ -1,11 +1,37 @@
 import time
 import datetime as dt
 import math
+import functools
 import numpy as np 
 import pandas as pd
-from scipy.signal import butter,filtfilt
-from scipy import interpolate
+from scipy.signal import butter,sosfiltfilt
 from scipy.interpolate import interp1d
+try:
+    from numba import njit
+except ImportError: # numba is optional, helpers run as plain python without it
+    def njit(*args, **kwargs):
+        if len(args)==1 and callable(args[0]):
+            return args[0]
+        return lambda f: f
+
+# designed filters are cached on (fs, cutoff(s), order), as fs rarely changes within a batch
+@functools.lru_cache(maxsize=32)
+def _design_bandpass(fs, lo, hi, order=2):
+    ''' second-order sections of a zero phase butterworth bandpass, [lo, hi] in Hz
+    returned as nested tuples, as the cached value is shared by every caller at this rate
+    '''
+    nyq = 0.5 * fs
+    sos = butter(order, [lo / nyq, hi / nyq], btype='bandpass', output='sos')
+    return tuple(map(tuple, sos))
+
+@functools.lru_cache(maxsize=32)
+def _design_lowpass(fs, cut, order=2):
+    ''' second-order sections of a zero phase butterworth low-pass, cut in Hz
+    returned as nested tuples, as the cached value is shared by every caller at this rate
+    '''
+    nyq = 0.5 * fs
+    sos = butter(order, cut / nyq, btype='low', output='sos')
+    return tuple(map(tuple, sos))
 
 def diffed(sig):
     ''' This function takes the difference of a time series
@@ -21,28 +47,23 @@ def diffed(sig):
         dsig - new dataframe with the same index (sample points) as sig, with diffed values
               
     Related libraries: 
-    from scipy import interpolate
     import numpy as np
     import pandas as pd
     ''' 
 
     if not isinstance(sig, pd.DataFrame):
         sig = sig.to_frame()
-    cols = sig.columns
-    xnew = sig.index
-    dsig = pd.DataFrame(index = xnew)
-    dt = np.nanmean(np.diff(sig.index))
-    for c in cols:
-        d = sig[c].diff()
-        d=d.iloc[1:]
-        y = d.values
-        x=d.index-0.5*dt
-        f = interpolate.interp1d(x, y,fill_value='extrapolate')
-        ynew = f(xnew)   # use interpolation function returned by `interp1d`
-        dsig[c] = ynew
+    # on an even grid, shifting the diffs back by half a sample is the mean of
+    # neighbouring diffs, with linear extrapolation at both ends
+    d = np.diff(sig.values, axis=0)
+    dvals = np.empty((d.shape[0]+1, d.shape[1]))
+    dvals[1:-1] = 0.5*(d[:-1] + d[1:])
+    dvals[0] = 1.5*d[0] - 0.5*d[1]
+    dvals[-1] = 1.5*d[-1] - 0.5*d[-2]
+    dsig = pd.DataFrame(dvals, index = sig.index, columns = sig.columns)
     return dsig
 
-def respnormed(sig,scaling=0):
+def respnormed(sig,scaling=0,dt=None):
     ''' a function to filter and normalise chest expansion recordings of respiration
     Respiration functions are bandpass filtered with cutoffs [0.05, 1] Hz
     zero phase butterworth.
@@ -54,12 +75,14 @@ def respnormed(sig,scaling=0):
               If blank, the function scales by median inspiration velocity 
               If scaling=1, the function presevers the input signal unites (but sets average to 0)
               If scaling=C, the signal values are multiplied by the float C
+        dt - optional sample interval in seconds, if already known
+              If None (default), it is taken from the first gaps of the index
     Output:
         nsig - new dataframe with the same index (sample points) as sig, 
               with sig filtered and normalised according to inputs.
     
     Related libraries: 
-    from scipy.signal import butter,filtfilt
+    from scipy.signal import butter,sosfiltfilt
     import numpy as np
     import pandas as pd
     ''' 
@@ -76,28 +99,75 @@ def respnormed(sig,scaling=0):
     cols = sig.columns
     d = sig.add(-sig.mean())
     
-    nsig = pd.DataFrame(index = times)
-    dt = np.nanmean(np.diff(sig.index))
-    fs = round(1/dt)
+    dt = _sample_interval(sig, dt)
+    fs = int(round(1.0/dt))
     
-    cutoff = np.array([0.05,1]) 
-    nyq = 0.5 * fs 
-    order = 2 
-    normal_cutoff = cutoff / nyq
-    b, a = butter(order, normal_cutoff, btype='bandpass', analog=False)
-        
-    for c in cols:
-        s = d[c].loc[d[c].notna()]
-        y = filtfilt(b, a, s)
+    sos = np.array(_design_bandpass(fs, 0.05, 1, order=2))
+
+    # no nans: filter every column in one pass
+    if d.notna().all().all():
+        y = sosfiltfilt(sos, d.values, axis=0)
         if autoscale:
-            x = pd.Series(y/(fs*np.median(abs(np.diff(y)))),index=s.index)
+            y = y/_autoscale_factor(y, fs)
         else:
-            x = pd.Series(scaling*y,index=s.index)
-        nsig[str(c)] = x
+            y = scaling*y
+        nsig = pd.DataFrame(y, index = times, columns = [str(c) for c in cols])
+        return nsig
+
+    # nans: filter each column on its own non-nan samples, leave nan elsewhere
+    vals = np.full(d.shape, np.nan)
+    for j, c in enumerate(cols):
+        mask = d[c].notna().values
+        y = sosfiltfilt(sos, d[c].values[mask])
+        if autoscale:
+            vals[mask, j] = y/_autoscale_factor(y, fs)
+        else:
+            vals[mask, j] = scaling*y
+    nsig = pd.DataFrame(vals, index = times, columns = [str(c) for c in cols])
 
     return nsig
 
-def Inspiration_Extract(sig,filtered=False):
+def _autoscale_factor(y, fs):
+    ''' median inspiration velocity of filtered signal(s) y (per column), 
+    the respnormed scaling constant when none is given
+    '''
+    return fs*np.median(np.abs(np.diff(y, axis=0)), axis=0)
+
+def _sample_interval(sig, dt=None):
+    ''' returns the sample interval of an evenly sampled signal from the first
+    few gaps of its index, or dt unchanged if it was already evaluated upstream.
+    '''
+    if dt is None:
+        dt = np.nanmedian(np.diff(sig.index.values[:17]))
+    return dt
+
+def _clean_center(sig):
+    ''' returns a single column ('Raw') dataframe of sig with nans removed 
+    (they sneak in) and the mean subtracted, in one pass over the values.
+    '''
+    raw = np.asarray(sig.values, dtype=np.float64).reshape(len(sig), -1)[:,0]
+    mask = ~np.isnan(raw)
+    vals = raw[mask]
+    vals -= vals.mean()
+    df_sig = pd.DataFrame({'Raw': vals}, index=sig.index[mask])
+    return df_sig
+
+@njit(cache=True)
+def _mask_empty_segments(t, V, insp_t, segIn, segOut):
+    ''' zeros V (in place, velocities or their signs) over each [segIn[j], segOut[j]]
+    interval of t that holds no inspiration zero crossing from insp_t. 
+    t, insp_t, segIn and segOut are sorted timestamps, so one pass over each.
+    '''
+    k = 0
+    for j in range(len(segIn)):
+        while k < len(insp_t) and insp_t[k] < segIn[j]:
+            k += 1
+        if k == len(insp_t) or insp_t[k] > segOut[j]:
+            lo = np.searchsorted(t, segIn[j], side='left')
+            hi = np.searchsorted(t, segOut[j], side='right')
+            V[lo:hi] = 0
+
+def Inspiration_Extract(sig,filtered=False,dt=None,return_filt=False):
     ''' a function to extract the onsets of inspirations and expirations from chest expansion
     measurements. Parameters and criteria suitable recordings of respiration 
     on human adults without exertion or core movements or vocalisation. 
@@ -111,76 +181,78 @@ def Inspiration_Extract(sig,filtered=False):
         filtered - optional input (true false)
                 If false (default), sig will passed to function respnormed
                 If True, sig will evaluated directly, as its presumably been filtered 
+        dt - optional sample interval in seconds, if already known
+              If None (default), it is taken from the first gaps of the index
+        return_filt - optional input (true false)
+                If True, the filtered signal the onsets were found on is also returned
     Output:
         Breaths - two column dataframe with Inpsiration onset ('In')
                   and Expiration onset ('Ex') timepoints in signal 
                   index values. 
+        filt - (only if return_filt) Series of the filtered signal, in input units
+                  centred on 0, without the samples where sig is nan
     
     Related libraries: 
-    from scipy.signal import butter,filtfilt
+    from scipy.signal import butter,sosfiltfilt
     import numpy as np
     import pandas as pd
     local functions: respnormed, diffed
     ''' 
     # evaluate sampling parameters
-    dt = np.nanmean(np.diff(sig.index))
-    sf = round(1/dt)
-    # creat parallel dataframe to input sig
-    df_sig = pd.DataFrame(sig.values,index=sig.index)
-    df_sig = df_sig.rename(columns={0:'Raw'})
-    # remove nans (they sneak in)
-    df_sig = df_sig.loc[df_sig['Raw'].notna()]-df_sig.loc[df_sig['Raw'].notna()].mean()
+    dt = _sample_interval(sig, dt)
+    sf = int(round(1.0/dt))
+    # creat parallel dataframe to input sig, without nans and centred on 0
+    df_sig = _clean_center(sig)
     
     #prep derivatives of respiration signal
-    newResp = pd.DataFrame(index = df_sig.index)
     if not filtered:
-        newResp['Raw'] = df_sig['Raw']
-        newResp['Filt'] = respnormed(newResp['Raw'],scaling=1)
+        filt = respnormed(df_sig['Raw'],scaling=1,dt=dt).iloc[:,0]
     else:
-        newResp['Filt'] = df_sig['Raw']
-    newResp['Diff1'] = diffed(newResp['Filt'])
-#     newResp['Diff2'] = diffed(newResp['Diff1'])
-#     newResp['Diff3'] = diffed(newResp['Diff2'])
+        filt = df_sig['Raw']
+    filt = filt.rename('Filt')
+    filt_arr = filt.values
+    diff1 = diffed(filt).values[:,0]
+#     diff2 = diffed(diff1)
+#     diff3 = diffed(diff2)
 
     # set thresholds according the signal distributions
-    InspThresh = newResp['Diff1'].loc[newResp['Diff1']>0].mean()*sf*0.55
+    InspThresh = diff1[diff1>0].mean()*sf*0.55
     VelThresh = InspThresh/sf; # to exclud very small bumps in chest expansion
     
     # catch inspirations from zero crossings
-    cutoff = 0.2 
-    nyq = 0.5 * sf 
-    order = 2 
-    normal_cutoff = cutoff / nyq
-    b, a = butter(order, normal_cutoff, btype='low', analog=False)
-    newResp['Flatten'] = filtfilt(b, a, newResp['Filt'])
-    newResp['Crossings'] = (np.sign(newResp['Filt']- filtfilt(b, a, newResp['Filt']))).diff()
-    insp = newResp['Filt'].loc[newResp['Crossings']==2]
+    sos = np.array(_design_lowpass(sf, 0.2, order=2))
+    flat = sosfiltfilt(sos, filt_arr)
+    crossings = np.sign(filt_arr - flat).astype(np.int8)
+    cross_idx = np.nonzero(np.diff(crossings)==2)[0]+1
 
     # Define inspiration intervals on stretch derivative 
-    V = newResp['Diff1'].copy()
-    #V.loc[V<0] = 0
-    V.loc[V<VelThresh] = 0;
-    a = np.sign(V).diff()
-    segIn = a.index[a>0.5]-2/sf
-    segOut = a.index[a<-0.5]
+    t = filt.index.values
+    V = diff1.astype(np.float64, copy=True)
+    #V[V<0] = 0
+    np.putmask(V, V<VelThresh, 0.0)
+    # signs are taken once, cut intervals below are zeroed on sV directly
+    sV = np.sign(V).astype(np.int8)
+    a = np.diff(sV)
+    segIn = t[np.nonzero(a>0)[0]+1]-2/sf
+    segOut = t[np.nonzero(a<0)[0]+1]
     
     # cut possible incomplete insp intervals at ends
     if segOut[0]<segIn[0]: 
-        V.loc[:segOut[0]] = 0
+        sV[:np.searchsorted(t, segOut[0], side='right')] = 0
         segOut = segOut[1:]
     if len(segOut)<len(segIn): 
         segIn = segIn[:len(segOut)]
     
     # cut intervales of increase chest stretch without zero crossings
-    insp = insp[insp.index>segIn[0]]
-    for j in range(len(segIn)):
-        if len(insp.loc[segIn[j]:segOut[j]])<1:
-            V.loc[segIn[j]:segOut[j]] = 0
+    insp_t = t[cross_idx]
+    insp_t = insp_t[insp_t>segIn[0]]
+    _mask_empty_segments(t, sV, insp_t, np.asarray(segIn, dtype=np.float64),
+                         np.asarray(segOut, dtype=np.float64))
     
     # define breath intervals on remaining increases
-    a = np.sign(V).diff()
-    segIn = a.index[a>0.5]
-    segOut = a.index[a<-0.5]
+    a = np.diff(sV)
+    segIn = t[np.nonzero(a>0)[0]+1]
+    segOut = t[np.nonzero(a<0)[0]+1]
     
     # cut possible incomplete insp intervals at ends again
     if segOut[0]<segIn[0]: 
@@ -188,11 +260,13 @@ def Inspiration_Extract(sig,filtered=False):
     if len(segOut)<len(segIn): 
         segIn = segIn[:len(segOut)]
 
-    d = {'In': segIn,'Ex': segOut}
+    d = {'In': np.asarray(segIn, dtype=np.float64),'Ex': np.asarray(segOut, dtype=np.float64)}
     Breaths = pd.DataFrame(data = d)
+    if return_filt:
+        return Breaths, filt
     return Breaths
 
-def Breath_Features(sig,scalingfactor=0,filtered=False):
+def Breath_Features(sig,scalingfactor=0,filtered=False,dt=None,return_filt=False):
     ''' a function to extract breath-wise characteristics of chest expansion measurements
     taken on human adults without exertion or vocalisation (seated or standing still)
     It can evaluate raw recordings (with timestamp index) or preprocessed signals.
@@ -209,6 +283,10 @@ def Breath_Features(sig,scalingfactor=0,filtered=False):
                 optional argument for setting the scaling constant for preprocessing in respnormed
               If false (default), sig will passed to function respnormed
               If True, sig will evaluated directly, as its presumably been filtered
+        dt - optional sample interval in seconds, if already known
+              If None (default), it is taken from the first gaps of the index
+        return_filt - optional input (true false)
+                If True, the filtered signal from Inspiration_Extract is also returned
         
     Output:
         Breaths - many column dataframe reporting statistics on breaths 
@@ -222,35 +300,42 @@ def Breath_Features(sig,scalingfactor=0,filtered=False):
               'IE_Ratio' - Insp_T/Exp_T, usually a value between [0.2,1]
               'Insp_V' - Average velocity of inspiration (Depth/Insp_T)(usually a bit under mode)
               'Exp_V' - Average velocity of expiration (Depth/Exp_T) (usually over mode)
+        filt - (only if return_filt) filtered signal from Inspiration_Extract, in input units
     
     Related libraries: 
-    from scipy.signal import butter,filtfilt
+    from scipy.signal import butter,sosfiltfilt
     import numpy as np
     import pandas as pd
     local functions: respnormed, diffed,Inspiration_Extract
     '''
     # evaluate breath phase onsets with 
     # optional argument of scaling factor and filtering to prep signal
-    newResp = pd.DataFrame(index = sig.index)
-    if filtered:
-        Breaths = Inspiration_Extract(sig,filtered=True)  
-        newResp['Filt'] = sig
-    else:
-        Breaths = Inspiration_Extract(sig) 
+    # the signal filtered in Inspiration_Extract is reused rather than refiltered,
+    # respnormed is linear so scaling it afterwards gives the same values
+    dt = _sample_interval(sig, dt)
+    Breaths, filt = Inspiration_Extract(sig,filtered=filtered,dt=dt,return_filt=True)
+    filt_vals = filt.values
+    if not filtered:
         if not scalingfactor==0:
-            newResp['Filt'] = respnormed(sig,scaling=scalingfactor)
+            filt_vals = scalingfactor*filt_vals
         else:
-            newResp['Filt'] = respnormed(sig)
+            filt_vals = filt_vals/_autoscale_factor(filt_vals, int(round(1.0/dt)))
    
-    Breaths['Depth'] = newResp.loc[Breaths['Ex'].values,'Filt'].values-newResp.loc[Breaths['In'].values,'Filt'].values
-    Breaths['Insp_T'] = Breaths['Ex'] - Breaths['In']
-    a = Breaths['In'].diff()
-    Breaths.loc[:len(Breaths)-2,'Period_T'] = a[1:].values
-    Breaths['Exp_T'] = Breaths['Period_T'] - Breaths['Insp_T']
-    Breaths['IE_Ratio'] = Breaths['Insp_T']/Breaths['Exp_T'] 
-    Breaths['Insp_V'] = Breaths['Depth']/Breaths['Insp_T']
-    Breaths['Exp_V'] = Breaths['Depth']/Breaths['Exp_T']
+    # onsets are sample times of sig, so a searchsorted finds their positions exactly
+    t = filt.index.values
+    In = Breaths['In'].values
+    Breaths['Depth'] = filt_vals[np.searchsorted(t, Breaths['Ex'].values)] - filt_vals[np.searchsorted(t, In)]
+    D = Breaths['Depth'].values
+    InspT = Breaths['Ex'].values - In
+    PeriodT = np.empty_like(InspT)
+    PeriodT[:-1] = In[1:] - In[:-1]
+    PeriodT[-1:] = np.nan # no next inspiration for the last breath
+    ExpT = PeriodT - InspT
+    Breaths = Breaths.assign(Insp_T=InspT, Period_T=PeriodT, Exp_T=ExpT,
+                             IE_Ratio=InspT/ExpT, Insp_V=D/InspT, Exp_V=D/ExpT)
 
+    if return_filt:
+        return Breaths, filt
     return Breaths
 
 def Breath_Continues_Features(sig,scaling=0,filtered=False,interp_style='previous'):
@@ -289,42 +374,36 @@ def Breath_Continues_Features(sig,scaling=0,filtered=False,interp_style='previou
               'Exp_V' - Average velocity of expiration (Depth/Exp_T) (usually over mode)
     
     Related libraries: 
-    from scipy.signal import butter,filtfilt
+    from scipy.signal import butter,sosfiltfilt
     import numpy as np
     import pandas as pd
     local functions: respnormed, diffed,Inspiration_Extract
     '''
 
     # evaluate sampling parameters
-    dt = np.nanmean(np.diff(sig.index))
-    sf = round(1/dt)
-    # creat parallel dataframe to input sig
-    df_sig = pd.DataFrame(sig.values,index=sig.index)
-    df_sig = df_sig.rename(columns={0:'Raw'})
-    # remove nans (they sneak in)
-    df_sig = df_sig.loc[df_sig['Raw'].notna()]-df_sig.loc[df_sig['Raw'].notna()].mean()
+    dt = _sample_interval(sig)
+    # creat parallel dataframe to input sig, without nans and centred on 0
+    df_sig = _clean_center(sig)
     cols = df_sig.columns
     
-    #prep derivatives of respiration signal
+    # breath features, and the filtered signal they were evaluated on
+    Breaths, filt = Breath_Features(df_sig,scalingfactor=scaling,filtered=filtered,dt=dt,return_filt=True)
     RespFeatures = pd.DataFrame(index = df_sig.index)
     if not filtered:
         RespFeatures ['Raw'] = df_sig['Raw']
-        RespFeatures ['Filt'] = respnormed(RespFeatures ['Raw'],scaling=1)
-    else:
-        RespFeatures ['Filt'] = df_sig['Raw']
-    
-    if filtered:
-        Breaths = Breath_Features(df_sig,scalingfactor=scaling,filtered=True)
-    else:
-        Breaths = Breath_Features(df_sig,scalingfactor=scaling,filtered=False)
+    RespFeatures ['Filt'] = filt.values
     
+    # carry each breath's values forward from its onset (step lookup on sorted onsets),
+    # nan before the first onset
+    t = RespFeatures.index.values
+    iIn = np.searchsorted(Breaths['In'].values, t, side='right')-1
+    iEx = np.searchsorted(Breaths['Ex'].values, t, side='right')-1
     cols = Breaths.columns
+    out = {}
     for col in cols:    
-        if col.startswith('Ex'):
-            f = interp1d(Breaths['Ex'],Breaths[col], kind='previous',fill_value='extrapolate')
-        else:
-            f = interp1d(Breaths['In'],Breaths[col], kind='previous',fill_value='extrapolate')
-        RespFeatures[col]=f(RespFeatures.index)
+        i = iEx if col.startswith('Ex') else iIn
+        out[col] = np.where(i<0, np.nan, Breaths[col].values[np.maximum(i,0)])
+    RespFeatures = pd.concat([RespFeatures, pd.DataFrame(out, index=RespFeatures.index)], axis=1)
 
     return RespFeatures
 